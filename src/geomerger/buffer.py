@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right
 from typing import List
 
 from visionapi.messages_pb2 import SaeMessage
@@ -8,12 +9,17 @@ class MessageBuffer:
 
     def __init__(self, target_window_size_ms: int) -> None:
         self._messages: List[SaeMessage] = []
+        # Timestamps of self._messages (same order), to be able to bisect
+        self._timestamps: List[int] = []
         self._target_window_size_ms = target_window_size_ms
 
     def append(self, msg: SaeMessage) -> None:
-        self._messages.append(msg)
-        self._messages.sort(key=lambda m: m.frame.timestamp_utc_ms)
-    
+        timestamp = msg.frame.timestamp_utc_ms
+        # Insert after messages with the same timestamp to keep arrival order among them
+        idx = bisect_right(self._timestamps, timestamp)
+        self._timestamps.insert(idx, timestamp)
+        self._messages.insert(idx, msg)
+
     def pop_slice(self, min_slice_length_ms: float) -> List[SaeMessage]:
         '''
         Removes and returns all messages exceeding the target buffer length,
@@ -22,26 +28,24 @@ class MessageBuffer:
         '''
         if len(self._messages) == 0:
             return []
-        
-        cutoff_index = len(self._messages) - 1
-        for idx, msg in enumerate(self._messages):
-            if msg.frame.timestamp_utc_ms >= self._messages[0].frame.timestamp_utc_ms + min_slice_length_ms:
-                cutoff_index = idx
-                break
-        if not self._messages[-1].frame.timestamp_utc_ms - self._messages[cutoff_index].frame.timestamp_utc_ms >= self._target_window_size_ms:
+
+        cutoff_index = min(bisect_left(self._timestamps, self._timestamps[0] + min_slice_length_ms), len(self._messages) - 1)
+        if not self._timestamps[-1] - self._timestamps[cutoff_index] >= self._target_window_size_ms:
             return []
-        
-        messages = []
-        while self.is_healthy():
-            messages.append(self._messages.pop(0))
+
+        # All messages older than the target window (measured from the newest message)
+        pop_count = bisect_right(self._timestamps, self._timestamps[-1] - self._target_window_size_ms)
+        messages = self._messages[:pop_count]
+        del self._messages[:pop_count]
+        del self._timestamps[:pop_count]
         return messages
 
     def is_healthy(self) -> bool:
         '''Check if the buffer has enough messages to satisfy the window size condition.'''
-        return len(self._messages) > 0 and self._messages[-1].frame.timestamp_utc_ms - self._messages[0].frame.timestamp_utc_ms >= self._target_window_size_ms
-        
+        return len(self._messages) > 0 and self._timestamps[-1] - self._timestamps[0] >= self._target_window_size_ms
+
     def __len__(self) -> int:
         return len(self._messages)
-    
+
     def __getitem__(self, index) -> SaeMessage:
         return self._messages.__getitem__(index)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -13,7 +13,11 @@ class RedisConfig(BaseModel):
     output_stream_prefix: str = 'geomerger'
 
 class MergingConfig(BaseModel):
-    max_distance_m: float
+    # Distances are measured in a local projection with a fixed scale (see reference_latitude),
+    # therefore all merged cameras are expected to cover a small area (roughly within 0.1° of latitude)
+    max_distance_m: Annotated[float, Field(gt=0)]
+    # Latitude at which the projection scale is computed. Defaults to the latitude of the first detection seen.
+    reference_latitude: Optional[Annotated[float, Field(ge=-90, le=90)]] = None
     merging_window_ms: float
     target_mps: float
     expire_ids_after_s: float = 30
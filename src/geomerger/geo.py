@@ -1,5 +1,5 @@
 import math
-from typing import NamedTuple
+from typing import NamedTuple, Tuple
 
 class Coord(NamedTuple):
     """
@@ -26,6 +26,13 @@ def m_per_deg_lon(lat: float) -> float:
     lat_rad = math.radians(lat)
     return 111412.84 * math.cos(lat_rad) - 93.5 * math.cos(3 * lat_rad) + 0.118 * math.cos(5 * lat_rad)
 
+def deg_factors(lat: float) -> Tuple[float, float]:
+    """
+    Calculate the length of a degree of latitude and longitude (in that order) in meters at a certain latitude.
+    Meant to be computed once and reused for many coordinates at (approximately) the same latitude.
+    """
+    return m_per_deg_lat(lat), m_per_deg_lon(lat)
+
 def distance_m(coord1: Coord, coord2: Coord) -> float:
     """
     Calculates the euclidean distance in meters between coord1 and coord2. 
@@ -33,6 +40,5 @@ def distance_m(coord1: Coord, coord2: Coord) -> float:
     the accuracy decreases with increasing absolute latitude and difference in latitude.
     For small differences in latitude accuracy should be fine (e.g. <1° delta lat)
     """
-    abs_lat_delta = abs(coord1.lat - coord2.lat) * m_per_deg_lat(coord1.lat)
-    abs_lon_delta = abs(coord1.lon - coord2.lon) * m_per_deg_lon(coord1.lat)
-    return math.sqrt(abs_lat_delta ** 2 + abs_lon_delta ** 2)
+    m_lat, m_lon = deg_factors(coord1.lat)
+    return math.hypot((coord1.lat - coord2.lat) * m_lat, (coord1.lon - coord2.lon) * m_lon)
@@ -1,7 +1,7 @@
 import logging
+import math
 import time
 from collections import defaultdict
-from statistics import fmean
 from typing import Any, Dict, List, Optional, Tuple
 
 from prometheus_client import Counter, Histogram, Summary
@@ -9,10 +9,10 @@ from visionapi.messages_pb2 import Detection, SaeMessage
 
 from .buffer import MessageBuffer
 from .config import LogLevel, MergingConfig
-from .geo import Coord, distance_m
 from .mapper import ExpiringMapper
 from .mapper import MapperEntry as ME
-from .mapper import MapperError
+from .mapper import MapperError, MapperRole
+from .spatial import IndexedDetection, SpatialIndex
 
 logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s %(processName)-10s %(message)s')
 logger = logging.getLogger(__name__)
@@ -27,9 +27,18 @@ class GeoMerger:
     def __init__(self, config: MergingConfig, log_level: LogLevel) -> None:
         logger.setLevel(log_level.value)
         self._config = config
+        # Hot path copies of config values (pydantic attribute access is comparatively slow)
+        self._max_distance_m = config.max_distance_m
+        self._min_slice_length_ms = 1 / config.target_mps
+        self._output_stream_id = config.output_stream_id
 
         self._buffer = MessageBuffer(target_window_size_ms=config.merging_window_ms)
+        self._spatial_index = SpatialIndex(cell_size_m=config.max_distance_m, reference_latitude=config.reference_latitude)
         self._last_emission = 0
+        # Whether messages have been added since the last mapping / merging pass
+        self._dirty = False
+        # Output messages are serialized right away, so one instance can be reused for all of them
+        self._out_msg = SaeMessage()
         self._mapper = ExpiringMapper(entry_expiration_age_s=config.expire_ids_after_s)
 
     def __call__(self, input_proto) -> Any:
@@ -43,156 +52,140 @@ class GeoMerger:
 
         if input_msg is not None:
             self._buffer.append(input_msg)
+            self._spatial_index.insert(input_msg)
+            self._dirty = True
+
+        # Without new messages there is nothing to emit and all matches are the same as in the last pass
+        if not self._dirty:
+            return []
+        self._dirty = False
 
         self._update_mappings()
 
-        out_buffer = self._buffer.pop_slice(min_slice_length_ms=(1 / self._config.target_mps))
+        out_buffer = self._buffer.pop_slice(min_slice_length_ms=self._min_slice_length_ms)
         if len(out_buffer) == 0:
             return []
 
-        # Apply active mappings to all outgoing messages
-        out_buffer = self._apply_mappings(out_buffer)
+        for msg in out_buffer:
+            self._spatial_index.remove(msg)
 
-        # Remove all duplicate detections but the first
+        # Merge all outgoing messages into one, aggregating detections that are mapped to the same object
         out_msg = self._merge_messages(out_buffer)
 
-        # logger.debug(f'len buf: {len(self._buffer)}; len out: {len(out_buffer)}; since last: {round(time.time() - self._last_emission, 3)}')
+        # logger.debug(f'len buf: {len(self._buffer)}; len out: {len(out_buffer)}; since last: {round((time.monotonic_ns() - self._last_emission) / 1e9, 3)}')
 
-        self._last_emission = time.time()
-        return [(self._config.output_stream_id, self._pack_proto(out_msg))]
+        self._last_emission = time.monotonic_ns()
+        return [(self._output_stream_id, self._pack_proto(out_msg))]
         
     def _update_mappings(self):
         try:
             if self._buffer.is_healthy():
                 for buffer_msg in self._buffer:
-                    for buffer_det in buffer_msg.detections:
-                        match_det, match_msg = self._find_match(buffer_msg, buffer_det)
+                    for buffer_det in self._spatial_index.get_detections(buffer_msg):
+                        match_det = self._find_match(buffer_det)
                         
                         if match_det is not None:
-                            match_entry = ME(match_msg.frame.source_id, match_det.object_id)
-                            buffer_entry = ME(buffer_msg.frame.source_id, buffer_det.object_id)
-
-                            match (
-                                self._mapper.is_primary(match_entry),
-                                self._mapper.is_secondary(match_entry),
-                                self._mapper.is_primary(buffer_entry),
-                                self._mapper.is_secondary(buffer_entry),
-                            ):
-                                case (False, False, False, False) | (True, False, False, False):
+                            match_entry = ME(match_det.source_id, match_det.object_id)
+                            buffer_entry = ME(buffer_det.source_id, buffer_det.object_id)
+
+                            match_role, match_primary = self._mapper.resolve(match_entry)
+                            buffer_role, buffer_primary = self._mapper.resolve(buffer_entry)
+
+                            match (match_role, buffer_role):
+                                case (MapperRole.UNKNOWN, MapperRole.UNKNOWN) | (MapperRole.PRIMARY, MapperRole.UNKNOWN):
                                     # Both ids are new or the input is new
                                     self._mapper.map_secondary(buffer_entry, match_entry)
-                                    logger.info(f'Mapped {buffer_entry} to {match_entry}')
-                                case (False, True, False, False):
-                                    primary = self._mapper.get_primary(match_entry)
-                                    if not primary == buffer_entry and not primary.source_id == buffer_entry.source_id:
-                                        self._mapper.map_secondary(buffer_entry, primary)
-                                        logger.info(f'Mapped {buffer_entry} to {primary}')
-                                case (False, True, True, False):
-                                    primary = self._mapper.get_primary(match_entry)
-                                    if not primary == buffer_entry and not primary.source_id == buffer_entry.source_id:
-                                        self._mapper.demote_primary(buffer_entry, new_primary=primary, migrate_children=True)
-                                        logger.info(f'Demoted {buffer_entry} to secondary of {primary}')
-                                case (False, False, False, True):
-                                    primary = self._mapper.get_primary(buffer_entry)
-                                    if not primary == buffer_entry and not primary.source_id == match_entry.source_id:
-                                        self._mapper.map_secondary(match_entry, primary)
-                                        logger.info(f'Mapped {match_entry} to {primary}')
-                                case (True, False, True, False):
+                                    logger.info('Mapped %s to %s', buffer_entry, match_entry)
+                                case (MapperRole.SECONDARY, MapperRole.UNKNOWN):
+                                    if not match_primary == buffer_entry and not match_primary.source_id == buffer_entry.source_id:
+                                        self._mapper.map_secondary(buffer_entry, match_primary)
+                                        logger.info('Mapped %s to %s', buffer_entry, match_primary)
+                                case (MapperRole.SECONDARY, MapperRole.PRIMARY):
+                                    if not match_primary == buffer_entry and not match_primary.source_id == buffer_entry.source_id:
+                                        self._mapper.demote_primary(buffer_entry, new_primary=match_primary, migrate_children=True)
+                                        logger.info('Demoted %s to secondary of %s', buffer_entry, match_primary)
+                                case (MapperRole.UNKNOWN, MapperRole.SECONDARY):
+                                    if not buffer_primary == buffer_entry and not buffer_primary.source_id == match_entry.source_id:
+                                        self._mapper.map_secondary(match_entry, buffer_primary)
+                                        logger.info('Mapped %s to %s', match_entry, buffer_primary)
+                                case (MapperRole.PRIMARY, MapperRole.PRIMARY):
                                     self._mapper.demote_primary(buffer_entry, new_primary=match_entry, migrate_children=True)
-                                    logger.info(f'Demoted {buffer_entry} to secondary of {match_entry}')
-                                case (True, False, False, True):
-                                    if not self._mapper.is_secondary_for(buffer_entry, primary=match_entry):
+                                    logger.info('Demoted %s to secondary of %s', buffer_entry, match_entry)
+                                case (MapperRole.PRIMARY, MapperRole.SECONDARY):
+                                    if not buffer_primary == match_entry:
                                         self._mapper.remap_secondary(buffer_entry, match_entry)
-                                        logger.info(f'Remapped {buffer_entry} to {match_entry}')
+                                        logger.info('Remapped %s to %s', buffer_entry, match_entry)
                                 case state:
-                                    logger.error(f'This should not happen! Please debug. State: {state}; buffer_entry: {buffer_entry}; match_entry: {match_entry}')
+                                    logger.error('This should not happen! Please debug. State: %s; buffer_entry: %s; match_entry: %s', state, buffer_entry, match_entry)
         except MapperError:
             logger.error(f'Illegal state encountered', exc_info=True)
 
         
-    def _find_match(self, input_msg: SaeMessage, input_det: Detection) -> Tuple[Detection, SaeMessage]:
-        closest_det: Detection = None
-        closest_msg: SaeMessage = None
-        closest_distance: float = 999999
-        for msg in self._buffer:
-            # Do not match detections of the same source / camera
-            # TODO Prevent that from happening in the first place (-> performance)
-            if msg.frame.source_id == input_msg.frame.source_id:
+    def _find_match(self, input_det: IndexedDetection) -> IndexedDetection:
+        closest_det: IndexedDetection = None
+        closest_key: Tuple[float, int, int] = None
+        x, y = input_det.x, input_det.y
+        max_distance_sq = self._max_distance_m * self._max_distance_m
+        # Only detections within max_distance_m can match, so we only need to look at the neighbouring grid cells.
+        # Detections of the same source / camera and of different classes are never considered.
+        # TODO Treat some classes as equal (e.g. trucks and cars)
+        for det in self._spatial_index.query(x, y, class_id=input_det.class_id, exclude_source_id=input_det.source_id):
+            # Compare squared distances to avoid the square root (ranking by s_dist² * t_dist² is equivalent to s_dist * t_dist)
+            dx = det.x - x
+            dy = det.y - y
+            s_dist_sq = dx * dx + dy * dy
+            if s_dist_sq >= max_distance_sq:
                 continue
-            t_dist = abs(input_msg.frame.timestamp_utc_ms - msg.frame.timestamp_utc_ms)
-            for det in msg.detections:
-                # Do not match detections of different classes
-                # TODO Treat some classes as equal (e.g. trucks and cars)
-                if det.class_id != input_det.class_id:
-                    continue
-                s_dist = self._get_spatial_distance(input_det, det)
-                dist = s_dist * t_dist
-                if self._is_similar(input_det, det) and s_dist < self._config.max_distance_m:
-                    if closest_distance > dist:
-                        closest_distance = dist
-                        closest_det = det
-                        closest_msg = msg
-        return closest_det, closest_msg
-    
-    def _is_similar(self, det1: Detection, det2: Detection):
-        return all((
-            det1.class_id == det2.class_id,
-        ))
+            t_dist = input_det.timestamp_ms - det.timestamp_ms
+            # Break ties in buffer order
+            key = (s_dist_sq * t_dist * t_dist, det.timestamp_ms, det.seq)
+            if closest_key is None or key < closest_key:
+                closest_key = key
+                closest_det = det
+        return closest_det
     
-    def _get_spatial_distance(self, det1: Detection, det2: Detection) -> float:
-        return distance_m(
-            Coord(det1.geo_coordinate.latitude, det1.geo_coordinate.longitude), 
-            Coord(det2.geo_coordinate.latitude, det2.geo_coordinate.longitude)
-        )
-
-    def _apply_mappings(self, messages: List[SaeMessage]) -> List[SaeMessage]:
+    def _group_detections(self, messages: List[SaeMessage]) -> Dict[bytes, List[Detection]]:
+        '''Groups all detections by object id, applying active mappings on the way (i.e. secondaries are grouped under their primary's id)'''
+        dets_by_id: Dict[bytes, List[Detection]] = defaultdict(list)
         for msg in messages:
+            source_id = msg.frame.source_id
             for det in msg.detections:
-                if self._mapper.is_secondary(ME(msg.frame.source_id, det.object_id)):
-                    primary = self._mapper.get_primary(ME(msg.frame.source_id, det.object_id))
-                    det.object_id = primary.object_id
-        return messages
+                role, primary = self._mapper.resolve(ME(source_id, det.object_id))
+                object_id = primary.object_id if role == MapperRole.SECONDARY else det.object_id
+                dets_by_id[object_id].append(det)
+        return dets_by_id
     
     def _merge_messages(self, messages: List[SaeMessage]) -> SaeMessage:
-        '''Merges all given messages into one (dropping the frames)'''
+        '''Merges all given messages into one (dropping the frames). The returned message is only valid until the next call.'''
         if len(messages) == 0:
             return None
         
-        out_msg = SaeMessage()
+        out_msg = self._out_msg
+        out_msg.Clear()
         out_msg.frame.shape.CopyFrom(messages[0].frame.shape)
-        detections = []
-        earliest_timestamp = time.time_ns() // 1_000_000
 
-        for msg in messages:
-            detections.extend(msg.detections)
-            if msg.frame.timestamp_utc_ms < earliest_timestamp:
-                earliest_timestamp = msg.frame.timestamp_utc_ms
-
-        detections = self._aggregate_duplicate_detections(detections)
-        out_msg.detections.extend(detections)
-        out_msg.frame.timestamp_utc_ms = earliest_timestamp
+        self._aggregate_duplicate_detections(self._group_detections(messages), out_msg)
+        out_msg.frame.timestamp_utc_ms = min(msg.frame.timestamp_utc_ms for msg in messages)
         
         return out_msg
 
-    def _aggregate_duplicate_detections(self, detections: List[Detection]) -> List[Detection]:
-        aggregated_dets = []
-
-        dets_by_id: Dict[bytes, List[Detection]] = defaultdict(list)
-        for det in detections:
-            dets_by_id[det.object_id].append(det)
-
-        for dets in dets_by_id.values():
-            if len(dets) == 0:
-                continue
-            agg_det = Detection()
+    def _aggregate_duplicate_detections(self, dets_by_id: Dict[bytes, List[Detection]], out_msg: SaeMessage) -> None:
+        '''Adds one detection per object id to out_msg, averaging the duplicates (built in place to avoid copying detections into the message)'''
+        for object_id, dets in dets_by_id.items():
+            agg_det = out_msg.detections.add()
             agg_det.class_id = dets[0].class_id
-            agg_det.object_id = dets[0].object_id
-            agg_det.geo_coordinate.latitude = fmean([d.geo_coordinate.latitude for d in dets])
-            agg_det.geo_coordinate.longitude = fmean([d.geo_coordinate.longitude for d in dets])
-            agg_det.confidence = fmean([d.confidence for d in dets])
-            aggregated_dets.append(agg_det)
-
-        return aggregated_dets
+            agg_det.object_id = object_id
+            # Collect all averaged fields in one pass over the detections (fsum keeps the means as exact as statistics.fmean)
+            lats, lons, confs = [], [], []
+            for det in dets:
+                geo_coordinate = det.geo_coordinate
+                lats.append(geo_coordinate.latitude)
+                lons.append(geo_coordinate.longitude)
+                confs.append(det.confidence)
+            det_count = len(dets)
+            agg_det.geo_coordinate.latitude = math.fsum(lats) / det_count
+            agg_det.geo_coordinate.longitude = math.fsum(lons) / det_count
+            agg_det.confidence = math.fsum(confs) / det_count
 
     @PROTO_DESERIALIZATION_DURATION.time()
     def _unpack_proto(self, sae_message_bytes):
@@ -1,8 +1,8 @@
-import inspect
 import logging
 import time
-from collections import defaultdict
-from typing import Any, Dict, List, NamedTuple
+from collections import OrderedDict, defaultdict
+from enum import Enum
+from typing import Any, Dict, List, NamedTuple, Tuple
 
 from ratelimit import limits
 
@@ -13,7 +13,7 @@ def dict_to_text(d: Dict):
     text = ''
     for k, v in d.items():
         text += f'\n{k}:'
-        if isinstance(v, list):
+        if isinstance(v, (list, dict)):
             for e in v:
                 text += f'\n  {e}'
         else:
@@ -21,7 +21,7 @@ def dict_to_text(d: Dict):
     return text
 
 def id_to_str(id: bytes) -> str:
-    return bytes.hex(id)[:4]
+    return id[:2].hex()
 
 
 class MapperError(Exception):
@@ -36,6 +36,12 @@ class MapperEntry(NamedTuple):
         return f'[sid={self.source_id}, oid={id_to_str(self.object_id)}]'
 
 
+class MapperRole(Enum):
+    UNKNOWN = 0
+    PRIMARY = 1
+    SECONDARY = 2
+
+
 class Mapper:
     '''
     This is essentially a collection of small trees with a deliberately limited set of operations available.
@@ -43,8 +49,9 @@ class Mapper:
     '''
     
     def __init__(self) -> None:
-        self._secondaries_by_primary: Dict[MapperEntry, List[MapperEntry]] = defaultdict(list)
-        self._primary_by_secondary: Dict[MapperEntry, MapperEntry] = defaultdict(lambda: None)
+        # Secondaries are kept in (insertion ordered) dicts with None values, to be able to remove them in O(1)
+        self._secondaries_by_primary: Dict[MapperEntry, Dict[MapperEntry, None]] = defaultdict(dict)
+        self._primary_by_secondary: Dict[MapperEntry, MapperEntry] = {}
 
     def map_secondary(self, secondary: MapperEntry, primary: MapperEntry) -> None:
         '''Add a mapping from primary to secondary if it does not exist yet.'''
@@ -64,7 +71,7 @@ class Mapper:
         self._log_mappings()
 
     def _add_mapping(self, primary: MapperEntry, secondary: MapperEntry) -> None:
-        self._secondaries_by_primary[primary].append(secondary)
+        self._secondaries_by_primary[primary][secondary] = None
         self._primary_by_secondary[secondary] = primary
 
     def _remove_primary(self, primary: MapperEntry) -> None:
@@ -76,7 +83,9 @@ class Mapper:
     def _remove_secondary(self, secondary: MapperEntry) -> None:
         primary = self._primary_by_secondary.pop(secondary, None)
         if primary is not None:
-            self._primary_by_secondary[secondary]
+            secondaries = self._secondaries_by_primary.get(primary)
+            if secondaries is not None:
+                secondaries.pop(secondary, None)
 
     def remap_secondary(self, secondary: MapperEntry, new_primary: MapperEntry) -> None:
         if secondary.source_id == new_primary.source_id:
@@ -90,8 +99,8 @@ class Mapper:
             return
         
         old_primary = self.get_primary(secondary)
-        self._secondaries_by_primary[old_primary].remove(secondary)
-        self._secondaries_by_primary[new_primary].append(secondary)
+        del self._secondaries_by_primary[old_primary][secondary]
+        self._secondaries_by_primary[new_primary][secondary] = None
         self._primary_by_secondary[secondary] = new_primary
 
         self._log_mappings()
@@ -124,7 +133,19 @@ class Mapper:
     def get_secondaries(self, primary: MapperEntry) -> List[MapperEntry]:
         if not self.is_primary(primary):
             raise MapperError(f'Primary {primary} is not primary.')
-        return self._secondaries_by_primary[primary]
+        return list(self._secondaries_by_primary[primary])
+
+    def resolve(self, entry: MapperEntry) -> Tuple[MapperRole, MapperEntry]:
+        '''
+        Returns the role of entry and its primary in one go.
+        The primary of a primary is the entry itself, an unknown entry has no primary (None).
+        '''
+        primary = self._primary_by_secondary.get(entry)
+        if primary is not None:
+            return MapperRole.SECONDARY, primary
+        if entry in self._secondaries_by_primary:
+            return MapperRole.PRIMARY, entry
+        return MapperRole.UNKNOWN, None
 
     def is_primary(self, entry: MapperEntry) -> bool:
         return entry in self._secondaries_by_primary
@@ -139,7 +160,9 @@ class Mapper:
         return self.is_primary(entry) or self.is_secondary(entry)
     
     def _log_mappings(self) -> None:
-        logger.warning(dict_to_text(self._secondaries_by_primary))
+        # Formatting all mappings is expensive and this is called on every mutation
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(dict_to_text(self._secondaries_by_primary))
     
 
 class ExpiringMapper(Mapper):
@@ -147,26 +170,44 @@ class ExpiringMapper(Mapper):
         super().__init__()
 
         self._entry_expiration_age_s = entry_expiration_age_s
-        self._entries_last_seen: Dict[MapperEntry, float] = {}
+        # Kept ordered by last seen time (oldest first), so that expired entries can be taken from the front
+        self._entries_last_seen: OrderedDict[MapperEntry, float] = OrderedDict()
         self._expire_entries_limited = limits(calls=10, period=self._entry_expiration_age_s, raise_on_limit=False)(self._expire_entries)
-        
-        # Wrap all methods part of the public API to transparently track and expire entries
-        for name, method in inspect.getmembers(self, predicate=inspect.ismethod):
-            if not name.startswith('_'):
-                setattr(self, name, self._wrap_method(method))
- 
-    def _wrap_method(self, method):
-        def wrapper(*args, **kwargs):
-            for arg in [*args, *kwargs.values()]:
-                if isinstance(arg, MapperEntry):
-                    self._entries_last_seen[arg] = time.time()
-            self._expire_entries_limited()
-            return method(*args, **kwargs)
-        return wrapper
+
+    # All mutating methods and resolve() are overridden to transparently track and expire entries.
+    # The read-only predicates (is_*, get_*) are not tracked, as the mutators use them on entries they already track themselves.
+
+    def map_secondary(self, secondary: MapperEntry, primary: MapperEntry) -> None:
+        self._track(secondary, primary)
+        return super().map_secondary(secondary, primary)
+
+    def remap_secondary(self, secondary: MapperEntry, new_primary: MapperEntry) -> None:
+        self._track(secondary, new_primary)
+        return super().remap_secondary(secondary, new_primary)
+
+    def demote_primary(self, primary: MapperEntry, new_primary: MapperEntry, migrate_children: bool = False) -> None:
+        self._track(primary, new_primary)
+        return super().demote_primary(primary, new_primary, migrate_children)
+
+    def resolve(self, entry: MapperEntry) -> Tuple[MapperRole, MapperEntry]:
+        self._track(entry)
+        return super().resolve(entry)
+
+    def _track(self, *entries: MapperEntry) -> None:
+        now = time.monotonic()
+        for entry in entries:
+            self._entries_last_seen[entry] = now
+            self._entries_last_seen.move_to_end(entry)
+        self._expire_entries_limited()
     
     def _expire_entries(self):
-        expired_entries = [entry for entry, last_seen in self._entries_last_seen.items() if time.time() - last_seen > self._entry_expiration_age_s]
-        for entry in expired_entries:
+        now = time.monotonic()
+        entries_last_seen = self._entries_last_seen
+        # Pop expired entries off the front directly (the oldest entry is always first)
+        while len(entries_last_seen) > 0:
+            entry, last_seen = next(iter(entries_last_seen.items()))
+            if now - last_seen <= self._entry_expiration_age_s:
+                break
+            entries_last_seen.popitem(last=False)
             self._remove_primary(entry)
             self._remove_secondary(entry)
-            self._entries_last_seen.pop(entry, None)
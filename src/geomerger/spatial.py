@@ -0,0 +1,122 @@
+import math
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from visionapi.messages_pb2 import SaeMessage
+
+from .geo import deg_factors
+
+
+class IndexedDetection(NamedTuple):
+    '''Holds plain copies of all detection fields needed for matching, to avoid protobuf attribute access.'''
+    x: float
+    y: float
+    source_id: str
+    object_id: bytes
+    class_id: int
+    timestamp_ms: int
+    seq: int
+    msg: SaeMessage
+
+
+class SpatialIndex:
+    '''
+    Buckets detections into a uniform grid of square cells (in local metric coordinates).
+    As long as the search radius does not exceed the cell size, only the 3x3 cells around a point need to be looked at.
+    The projection uses one fixed scale (meters per degree at reference_latitude, or at the first seen latitude if not given),
+    which is only accurate within a small area (roughly within 0.1° of latitude of the reference).
+    '''
+
+    def __init__(self, cell_size_m: float, reference_latitude: Optional[float] = None) -> None:
+        self._cell_size_m = cell_size_m
+        self._m_per_deg_lat: float = None
+        self._m_per_deg_lon: float = None
+        if reference_latitude is not None:
+            self._m_per_deg_lat, self._m_per_deg_lon = deg_factors(reference_latitude)
+        # Grids are partitioned by (source_id, class_id), as only detections of other sources and the same class can match
+        self._partitions: Dict[Tuple[str, int], Dict[Tuple[int, int], List[IndexedDetection]]] = {}
+        # Messages are not hashable, therefore they are keyed by id (they are referenced by their detections, so ids can not be reused)
+        self._detections_by_msg: Dict[int, List[IndexedDetection]] = {}
+        self._next_seq = 0
+
+    def project(self, lat: float, lon: float) -> Tuple[float, float]:
+        '''Converts lat/lon into metric (x, y) coordinates.'''
+        if self._m_per_deg_lat is None:
+            if not _has_position(lat, lon):
+                # An unusable coordinate must not fix the scale for all later ones
+                m_per_deg_lat, m_per_deg_lon = deg_factors(lat)
+                return lon * m_per_deg_lon, lat * m_per_deg_lat
+            # No reference latitude configured, assume a small area and use the scale at the first seen latitude everywhere
+            self._m_per_deg_lat, self._m_per_deg_lon = deg_factors(lat)
+        return lon * self._m_per_deg_lon, lat * self._m_per_deg_lat
+
+    def insert(self, msg: SaeMessage) -> None:
+        source_id = msg.frame.source_id
+        timestamp_ms = msg.frame.timestamp_utc_ms
+        # All records are built before the grid is touched, so that a failing detection can not leave the message half inserted
+        detections = []
+        for det in msg.detections:
+            lat, lon = det.geo_coordinate.latitude, det.geo_coordinate.longitude
+            if not _has_position(lat, lon):
+                # Such detections can not be matched (they are still passed on in the merged output)
+                continue
+            x, y = self.project(lat, lon)
+            # (timestamp_ms, seq) orders detections like the (timestamp sorted) message buffer, to be able to break ties consistently
+            detections.append(IndexedDetection(x, y, source_id, det.object_id, det.class_id, timestamp_ms, self._next_seq, msg))
+            self._next_seq += 1
+        for indexed_det in detections:
+            cells = self._partitions.get((source_id, indexed_det.class_id))
+            if cells is None:
+                cells = self._partitions[(source_id, indexed_det.class_id)] = defaultdict(list)
+            cells[self._get_cell(indexed_det.x, indexed_det.y)].append(indexed_det)
+        self._detections_by_msg[id(msg)] = detections
+
+    def remove(self, msg: SaeMessage) -> None:
+        # Collect the touched cells first, so that each one is filtered only once (and not once per detection in it)
+        touched_cells = set()
+        for indexed_det in self._detections_by_msg.pop(id(msg), []):
+            touched_cells.add(((indexed_det.source_id, indexed_det.class_id), self._get_cell(indexed_det.x, indexed_det.y)))
+        for partition, cell in touched_cells:
+            cells = self._partitions.get(partition)
+            if cells is None:
+                continue
+            detections = [d for d in cells.get(cell, []) if d.msg is not msg]
+            if len(detections) > 0:
+                cells[cell] = detections
+            else:
+                cells.pop(cell, None)
+                if len(cells) == 0:
+                    del self._partitions[partition]
+
+    def get_detections(self, msg: SaeMessage) -> List[IndexedDetection]:
+        '''Returns the indexed detections of msg (in the same order as msg.detections, without the ones lacking a usable position).'''
+        return self._detections_by_msg.get(id(msg), [])
+
+    def query(self, x: float, y: float, class_id: Optional[int] = None, exclude_source_id: Optional[str] = None) -> List[IndexedDetection]:
+        '''
+        Returns all detections in the cell containing (x, y) and its neighbours.
+        If given, only detections of class_id and not originating from exclude_source_id are returned.
+        '''
+        cell_x, cell_y = self._get_cell(x, y)
+        neighbours = [(neighbour_x, neighbour_y) for neighbour_x in (cell_x - 1, cell_x, cell_x + 1) for neighbour_y in (cell_y - 1, cell_y, cell_y + 1)]
+        # Collecting the candidates in one list is a lot cheaper than yielding them one by one
+        candidates = []
+        for (source_id, partition_class_id), cells in self._partitions.items():
+            if source_id == exclude_source_id or (class_id is not None and partition_class_id != class_id):
+                continue
+            for neighbour in neighbours:
+                detections = cells.get(neighbour)
+                if detections is not None:
+                    candidates.extend(detections)
+        return candidates
+
+    def _get_cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x // self._cell_size_m), int(y // self._cell_size_m)
+
+    def __len__(self) -> int:
+        return sum(len(detections) for cells in self._partitions.values() for detections in cells.values())
+
+
+def _has_position(lat: float, lon: float) -> bool:
+    # (0, 0) is what an unset protobuf geo_coordinate reads as
+    return math.isfinite(lat) and math.isfinite(lon) and not (lat == 0 and lon == 0)
@@ -4,6 +4,7 @@ import threading
 import time
 from typing import List, Tuple
 
+from google.protobuf.internal import api_implementation
 from prometheus_client import Counter, Histogram, start_http_server
 from visionlib.pipeline.consumer import RedisConsumer
 from visionlib.pipeline.publisher import RedisPublisher
@@ -35,6 +36,10 @@ def run_stage():
 
     logger.setLevel(CONFIG.log_level.value)
 
+    # Proto (de)serialization happens for every message, the pure python implementation is an order of magnitude slower than upb / cpp
+    if api_implementation.Type() == 'python':
+        logger.warning('protobuf is using its pure python implementation. Make sure a protobuf wheel with the upb backend is installed.')
+
     logger.info(f'Starting prometheus metrics endpoint on port {CONFIG.prometheus_port}')
 
     start_http_server(CONFIG.prometheus_port)
@@ -41,6 +41,20 @@ def test_pop_slice():
     assert slice[1].frame.timestamp_utc_ms == 10100
     assert slice[2].frame.timestamp_utc_ms == 10200
 
+def test_append_out_of_order():
+    testee = MessageBuffer(target_window_size_ms=1000)
+
+    testee.append(create_msg(10200))
+    testee.append(create_msg(10000))
+    first = create_msg(10100)
+    second = create_msg(10100)
+    testee.append(first)
+    testee.append(second)
+
+    assert [msg.frame.timestamp_utc_ms for msg in testee] == [10000, 10100, 10100, 10200]
+    assert testee[1] is first
+    assert testee[2] is second
+
 def test_pop_slice_empty():
     testee = MessageBuffer(target_window_size_ms=1000)
     assert len(testee.pop_slice(min_slice_length_ms=100)) == 0
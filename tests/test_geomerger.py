@@ -38,4 +38,38 @@ def test_geomerger(testee, test_data):
     output = []
     for proto_bytes in test_data:
         output.extend(testee.get(proto_bytes))
-    assert len(output) == 189
\ No newline at end of file
+    assert len(output) == 189
+
+def test_get_without_input(testee, test_data, monkeypatch):
+    for proto_bytes in test_data[:20]:
+        testee.get(proto_bytes)
+
+    def fail():
+        raise AssertionError('_update_mappings must not run without new messages')
+    monkeypatch.setattr(testee, '_update_mappings', fail)
+
+    assert testee.get() == []
+
+def test_find_match_breaks_ties_in_buffer_order(testee):
+    # All candidates are equally far away in space and time (+-100ms) from the input detection
+    earlier = create_msg('s2', 900, [(b'obj1', 52.0, 10.00001), (b'obj2', 52.0, 10.00001)])
+    later = create_msg('s2', 1100, [(b'obj3', 52.0, 10.00001)])
+    input_msg = create_msg('s1', 1000, [(b'obj4', 52.0, 10.0)])
+    # The later message is indexed first, so that the insertion order alone does not decide
+    for msg in (later, earlier, input_msg):
+        testee._spatial_index.insert(msg)
+
+    match = testee._find_match(testee._spatial_index.get_detections(input_msg)[0])
+
+    assert match.object_id == b'obj1'
+
+def create_msg(source_id: str, timestamp_ms: int, detections) -> SaeMessage:
+    msg = SaeMessage()
+    msg.frame.source_id = source_id
+    msg.frame.timestamp_utc_ms = timestamp_ms
+    for object_id, lat, lon in detections:
+        det = msg.detections.add()
+        det.object_id = object_id
+        det.geo_coordinate.latitude = lat
+        det.geo_coordinate.longitude = lon
+    return msg
@@ -4,7 +4,7 @@ import pytest
 
 from geomerger.mapper import ExpiringMapper, Mapper
 from geomerger.mapper import MapperEntry as ME
-from geomerger.mapper import MapperError
+from geomerger.mapper import MapperError, MapperRole
 
 
 def test_map_secondary():
@@ -103,6 +103,19 @@ def test_demote_primary_migrate():
     assert testee.is_secondary_for(prim, prim2)
     assert testee.get_secondaries(prim2) == [prim, sec, sec2]
 
+def test_resolve():
+    testee = Mapper()
+
+    prim = ME('s1', b'pri1')
+    sec = ME('s2', b'sec1')
+    unknown = ME('s3', b'unk1')
+
+    testee.map_secondary(sec, prim)
+
+    assert testee.resolve(prim) == (MapperRole.PRIMARY, prim)
+    assert testee.resolve(sec) == (MapperRole.SECONDARY, prim)
+    assert testee.resolve(unknown) == (MapperRole.UNKNOWN, None)
+
 def test_source_constraint():
     testee = Mapper()
 
@@ -150,3 +163,46 @@ def test_expiration():
 
     assert testee.is_known(prim) == False
     assert testee.is_known(prim2) == True
+
+def test_expiration_secondary():
+    testee = ExpiringMapper(entry_expiration_age_s=0.2)
+
+    prim = ME('s1', b'pri1')
+    sec = ME('s2', b'sec1')
+    sec2 = ME('s2', b'sec2')
+
+    testee.map_secondary(sec, prim)
+
+    time.sleep(0.5)
+
+    # Touches prim (but not sec) before expiring old entries
+    testee.map_secondary(sec2, prim)
+
+    assert testee.is_known(sec) == False
+    assert testee.get_secondaries(prim) == [sec2]
+
+def test_expiration_after_refresh():
+    testee = ExpiringMapper(entry_expiration_age_s=0.5)
+
+    prim = ME('s1', b'pri1')
+    prim2 = ME('s1', b'pri2')
+    prim3 = ME('s1', b'pri3')
+    sec = ME('s2', b'sec1')
+    sec2 = ME('s2', b'sec2')
+    sec3 = ME('s2', b'sec3')
+
+    testee.map_secondary(sec, prim)
+    time.sleep(0.05)
+    testee.map_secondary(sec2, prim2)
+    time.sleep(0.25)
+
+    # Refreshes the oldest entries, so that they are now newer than sec2 and prim2
+    testee.resolve(sec)
+    testee.resolve(prim)
+    time.sleep(0.35)
+
+    testee.map_secondary(sec3, prim3)
+
+    assert testee.is_known(sec2) == False
+    assert testee.is_known(prim2) == False
+    assert testee.get_secondaries(prim) == [sec]
@@ -0,0 +1,121 @@
+import math
+
+from visionapi.messages_pb2 import SaeMessage
+
+from geomerger.spatial import SpatialIndex
+
+
+def test_query_neighbourhood():
+    testee = SpatialIndex(cell_size_m=2)
+
+    msg = create_msg('s1', 1000, [(52.0, 10.0), (52.00001, 10.0), (52.001, 10.0)])
+    testee.insert(msg)
+
+    x, y = testee.project(52.0, 10.0)
+    entries = list(testee.query(x, y))
+
+    # The third detection is ~100m away and must not be considered
+    assert len(entries) == 2
+    assert all(entry.msg is msg for entry in entries)
+
+def test_query_filters():
+    testee = SpatialIndex(cell_size_m=2)
+
+    msg1 = create_msg('s1', 1000, [(52.0, 10.0), (52.0, 10.0)])
+    msg1.detections[1].class_id = 2
+    msg2 = create_msg('s2', 1000, [(52.0, 10.0)])
+    testee.insert(msg1)
+    testee.insert(msg2)
+
+    x, y = testee.project(52.0, 10.0)
+
+    assert len(testee.query(x, y)) == 3
+    assert len(testee.query(x, y, class_id=0)) == 2
+    assert [entry.msg for entry in testee.query(x, y, class_id=0, exclude_source_id='s1')] == [msg2]
+    assert testee.query(x, y, class_id=2, exclude_source_id='s1') == []
+
+def test_remove():
+    testee = SpatialIndex(cell_size_m=2)
+
+    msg1 = create_msg('s1', 1000, [(52.0, 10.0)])
+    msg2 = create_msg('s2', 1100, [(52.0, 10.0)])
+    testee.insert(msg1)
+    testee.insert(msg2)
+
+    assert len(testee) == 2
+
+    testee.remove(msg1)
+
+    entries = list(testee.query(*testee.project(52.0, 10.0)))
+    assert len(entries) == 1
+    assert entries[0].msg is msg2
+
+    testee.remove(msg2)
+
+    assert len(testee) == 0
+
+def test_entry_fields():
+    testee = SpatialIndex(cell_size_m=2)
+
+    msg = create_msg('s1', 1000, [(52.0, 10.0)])
+    msg.detections[0].class_id = 2
+    testee.insert(msg)
+
+    entry = testee.query(*testee.project(52.0, 10.0))[0]
+    assert entry.source_id == 's1'
+    assert entry.class_id == 2
+    assert entry.timestamp_ms == 1000
+    assert entry.msg is msg
+
+def test_get_detections():
+    testee = SpatialIndex(cell_size_m=2)
+
+    msg = create_msg('s1', 1000, [(52.0, 10.0), (52.001, 10.0)])
+    msg.detections[0].object_id = b'obj1'
+    msg.detections[1].object_id = b'obj2'
+    testee.insert(msg)
+
+    assert [d.object_id for d in testee.get_detections(msg)] == [b'obj1', b'obj2']
+
+    testee.remove(msg)
+
+    assert testee.get_detections(msg) == []
+
+def test_reference_latitude():
+    testee = SpatialIndex(cell_size_m=2, reference_latitude=52.0)
+
+    # The scale is fixed by the reference latitude, not by the first detection
+    testee.insert(create_msg('s1', 1000, [(10.0, 10.0)]))
+    x1, _ = testee.project(52.0, 10.0)
+    x2, _ = testee.project(52.0, 10.00001)
+
+    assert 0.6 < x2 - x1 < 0.7
+
+def test_unusable_coordinates():
+    testee = SpatialIndex(cell_size_m=2)
+
+    msg = create_msg('s1', 1000, [(math.nan, 10.0), (0.0, 0.0), (52.0, math.inf), (52.0, 10.0)])
+    msg.detections[3].object_id = b'obj1'
+    testee.insert(msg)
+
+    assert len(testee) == 1
+    assert [d.object_id for d in testee.get_detections(msg)] == [b'obj1']
+
+    # The scale is taken from the first usable latitude, not from the NaN or (0, 0) detection
+    x1, _ = testee.project(52.0, 10.0)
+    x2, _ = testee.project(52.0, 10.00001)
+    assert 0.6 < x2 - x1 < 0.7
+
+    testee.remove(msg)
+
+    assert len(testee) == 0
+
+def create_msg(source_id: str, timestamp_ms: int, coords) -> SaeMessage:
+    msg = SaeMessage()
+    msg.frame.source_id = source_id
+    msg.frame.timestamp_utc_ms = timestamp_ms
+    for lat, lon in coords:
+        det = msg.detections.add()
+        det.geo_coordinate.latitude = lat
+        det.geo_coordinate.longitude = lon
+    return msg